@@ -1,13 +1,19 @@
+import hashlib
 import json
 from decimal import Decimal
-from typing import Dict, List
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from django.contrib import messages
-from django.db import transaction
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
-from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import etag, require_GET, require_POST
 
 from core.cart.models import Cart, CartItem
 from core.products.models import Category, Product
@@ -17,6 +23,22 @@ from .forms import CategoryForm, ProductForm
 
 SESSION_CART_KEY = "shopping_cart"
 RECENT_PURCHASES_LIMIT = 10
+PRODUCT_LIST_CHUNK_SIZE = 2000
+CART_ITEMS_BATCH_SIZE = 1000
+
+
+def _json_response(data: Dict[str, object], **kwargs) -> JsonResponse:
+    return JsonResponse(data, json_dumps_params={"ensure_ascii": False}, **kwargs)
+
+
+def _iter_json_list(key: str, rows: Iterable[Dict[str, object]]) -> Iterator[str]:
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    yield f'{{"{key}": ['
+    separator = ""
+    for row in rows:
+        yield separator + encoder.encode(row)
+        separator = ", "
+    yield "]}"
 
 
 def _get_session_cart(request) -> Dict[str, Dict[str, str]]:
@@ -31,50 +53,86 @@ def _save_session_cart(request, cart: Dict[str, Dict[str, str]]) -> None:
     request.session.modified = True
 
 
+def _save_and_serialize_cart(request, cart: Dict[str, Dict[str, str]]) -> Dict[str, object]:
+    _save_session_cart(request, cart)
+    return _serialize_cart(cart)
+
+
+def _build_cart_entry(name: str, quantity: int, unit_price: Decimal) -> Dict[str, object]:
+    return {
+        "quantity": quantity,
+        "name": name,
+        "unit_price": f"{unit_price:.2f}",
+        "line_total": f"{unit_price * quantity:.2f}",
+    }
+
+
 def _serialize_cart(cart: Dict[str, Dict[str, str]]) -> Dict[str, object]:
-    items: List[Dict[str, object]] = []
+    if not cart:
+        return {"items": [], "total": "0.00", "count": 0}
+
+    keyed_items: List[Tuple[str, Dict[str, object]]] = []
     total = Decimal("0.00")
     count = 0
     for product_id, data in cart.items():
-        try:
-            quantity = int(data.get("quantity", 0))
-        except (ValueError, TypeError):
-            quantity = 0
-        price = Decimal(str(data.get("unit_price", "0")))
-        line_total = price * quantity
-        total += line_total
+        if "line_total" not in data:
+            # Entries stored before line totals were cached in the session.
+            try:
+                legacy_quantity = int(data.get("quantity", 0))
+            except (ValueError, TypeError):
+                legacy_quantity = 0
+            data = _build_cart_entry(
+                data.get("name", ""),
+                legacy_quantity,
+                Decimal(str(data.get("unit_price", "0"))),
+            )
+        quantity = data["quantity"]
+        line_total = data["line_total"]
+        total += Decimal(line_total)
         count += quantity
-        items.append(
-            {
-                "product_id": int(product_id),
-                "name": data.get("name", ""),
-                "quantity": quantity,
-                "unit_price": f"{price:.2f}",
-                "line_total": f"{line_total:.2f}",
-            }
+        keyed_items.append(
+            (
+                data["name"].lower(),
+                {
+                    "product_id": int(product_id),
+                    "name": data["name"],
+                    "quantity": quantity,
+                    "unit_price": data["unit_price"],
+                    "line_total": line_total,
+                },
+            )
         )
 
-    items.sort(key=lambda item: item["name"].lower())
+    keyed_items.sort(key=itemgetter(0))
     return {
-        "items": items,
+        "items": [item for _, item in keyed_items],
         "total": f"{total:.2f}",
         "count": count,
     }
 
 
-def _serialize_purchase(cart: Cart) -> Dict[str, object]:
-    items = []
-    for item in cart.items.all():
-        line_total = item.unit_price * item.quantity
-        items.append(
-            {
-                "product": item.product.name,
-                "product_id": item.product_id,
-                "quantity": item.quantity,
-                "unit_price": f"{item.unit_price:.2f}",
-                "line_total": f"{line_total:.2f}",
-            }
-        )
+def _serialize_purchase_line(
+    product_name: str, product_id: int, quantity: int, unit_price: Decimal
+) -> Dict[str, object]:
+    return {
+        "product": product_name,
+        "product_id": product_id,
+        "quantity": quantity,
+        "unit_price": f"{unit_price:.2f}",
+        "line_total": f"{unit_price * quantity:.2f}",
+    }
+
+
+def _serialize_purchase(
+    cart: Cart, items: List[Dict[str, object]] | None = None
+) -> Dict[str, object]:
+    if items is None:
+        items = [
+            _serialize_purchase_line(
+                item.product.name, item.product_id, item.quantity, item.unit_price
+            )
+            for item in cart.items.all()
+        ]
     return {
         "id": cart.id,
         "created_at": cart.created_at.isoformat(),
@@ -84,29 +142,57 @@ def _serialize_purchase(cart: Cart) -> Dict[str, object]:
 
 
 def _recent_purchases(limit: int = RECENT_PURCHASES_LIMIT) -> List[Dict[str, object]]:
-    carts = (
-        Cart.objects.all()
-        .prefetch_related("items__product")
-        .order_by("-created_at")[:limit]
+    carts = list(
+        Cart.objects.order_by("-created_at").values("id", "created_at", "total_price")[:limit]
+    )
+    if not carts:
+        return []
+
+    rows = (
+        CartItem.objects.filter(cart_id__in=[cart["id"] for cart in carts])
+        .order_by("cart_id", "id")
+        .values_list("cart_id", "product__name", "product_id", "quantity", "unit_price")
     )
-    return [_serialize_purchase(cart) for cart in carts]
+    items_by_cart = {
+        cart_id: [_serialize_purchase_line(*row[1:]) for row in cart_rows]
+        for cart_id, cart_rows in groupby(rows, key=itemgetter(0))
+    }
+    return [
+        {
+            "id": cart["id"],
+            "created_at": cart["created_at"].isoformat(),
+            "total_price": f"{cart['total_price']:.2f}",
+            "items": items_by_cart.get(cart["id"], []),
+        }
+        for cart in carts
+    ]
 
 
 def product_list(request):
-    """Return a lightweight JSON list of active products."""
+    """Stream a lightweight JSON list of active products."""
 
     products = (
         Product.objects.filter(is_active=True)
         .order_by("name")
         .values("id", "name", "slug", "price", "stock")
+        .iterator(chunk_size=PRODUCT_LIST_CHUNK_SIZE)
+    )
+    return StreamingHttpResponse(
+        _iter_json_list("products", products),
+        content_type="application/json",
     )
-    return JsonResponse({"products": list(products)})
 
 
 def product_manage_list(request):
     """Display all products for management and quick access to category admin."""
 
-    products = Product.objects.all().select_related().prefetch_related("categories").order_by("name")
+    products = (
+        Product.objects.only("id", "name", "slug", "price", "stock", "is_active")
+        .prefetch_related(
+            Prefetch("categories", queryset=Category.objects.only("id", "name", "slug"))
+        )
+        .order_by("name")
+    )
     categories = Category.objects.all().order_by("name")
     purchases_data = _recent_purchases()
     initial_cart = _serialize_cart(_get_session_cart(request))
@@ -241,10 +327,17 @@ def category_delete(request, pk: int):
     )
 
 
+def _cart_etag(request) -> str:
+    payload = json.dumps(_get_session_cart(request), sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=8).hexdigest()
+
+
 @require_GET
+@cache_control(private=True, no_cache=True)
+@etag(_cart_etag)
 def cart_detail(request):
     cart = _serialize_cart(_get_session_cart(request))
-    return JsonResponse({"status": "ok", "cart": cart})
+    return _json_response({"status": "ok", "cart": cart})
 
 
 @require_POST
@@ -252,7 +345,7 @@ def cart_add(request):
     try:
         payload = json.loads(request.body.decode("utf-8"))
     except (json.JSONDecodeError, AttributeError):
-        return JsonResponse({"error": "JSON invalido."}, status=400)
+        return _json_response({"error": "JSON invalido."}, status=400)
 
     product_id = payload.get("product_id")
     quantity = payload.get("quantity", 1)
@@ -260,7 +353,7 @@ def cart_add(request):
     try:
         product_id = int(product_id)
     except (ValueError, TypeError):
-        return JsonResponse({"error": "Identificador de producto invalido."}, status=400)
+        return _json_response({"error": "Identificador de producto invalido."}, status=400)
 
     try:
         quantity = int(quantity)
@@ -268,41 +361,39 @@ def cart_add(request):
         quantity = 1
 
     if quantity <= 0:
-        return JsonResponse({"error": "La cantidad debe ser mayor a cero."}, status=400)
-
-    product = get_object_or_404(Product, pk=product_id)
+        return _json_response({"error": "La cantidad debe ser mayor a cero."}, status=400)
 
     cart = _get_session_cart(request)
-    key = str(product.id)
-    stored = cart.get(key, {"quantity": 0, "name": product.name, "unit_price": str(product.price)})
-    previous_quantity = int(stored.get("quantity", 0))
-    stored.update(
-        {
-            "quantity": previous_quantity + quantity,
-            "name": product.name,
-            "unit_price": str(product.price),
-        }
+    key = str(product_id)
+    # A single narrow row read keeps the active check and refreshes the name
+    # and price of lines that were added earlier.
+    row = (
+        Product.objects.filter(pk=product_id, is_active=True)
+        .values_list("name", "price")
+        .first()
     )
-    cart[key] = stored
-    _save_session_cart(request, cart)
+    if row is None:
+        return _json_response({"error": "Producto no encontrado."}, status=404)
 
-    return JsonResponse(
+    product_name, price = row
+    previous_quantity = int(cart.get(key, {}).get("quantity", 0))
+    cart[key] = _build_cart_entry(product_name, previous_quantity + quantity, price)
+    return _json_response(
         {
             "status": "ok",
-            "detail": f"{product.name} agregado al carrito.",
-            "cart": _serialize_cart(cart),
+            "detail": f"{product_name} agregado al carrito.",
+            "cart": _save_and_serialize_cart(request, cart),
         }
     )
 
 
 @require_POST
 def cart_clear(request):
-    _save_session_cart(request, {})
-    return JsonResponse(
+    return _json_response(
         {
             "status": "ok",
             "detail": "Carrito vaciado.",
-            "cart": _serialize_cart({}),
+            "cart": _save_and_serialize_cart(request, {}),
         }
     )
 
@@ -313,50 +404,60 @@ def cart_checkout(request):
     serialized = _serialize_cart(cart_data)
 
     if serialized["count"] <= 0:
-        return JsonResponse({"error": "El carrito esta vacio."}, status=400)
+        return _json_response({"error": "El carrito esta vacio."}, status=400)
 
     product_ids = [item["product_id"] for item in serialized["items"]]
-    products = {
-        product.id: product for product in Product.objects.filter(id__in=product_ids)
-    }
-
-    if len(products) != len(product_ids):
-        return JsonResponse(
-            {"error": "Alguno de los productos ya no esta disponible."}, status=400
+    with transaction.atomic():
+        product_names = dict(
+            Product.objects.select_for_update(
+                no_key=connection.features.has_select_for_no_key_update
+            )
+            .filter(id__in=product_ids, is_active=True)
+            .values_list("id", "name")
         )
 
-    with transaction.atomic():
+        if len(product_names) != len(product_ids):
+            return _json_response(
+                {"error": "Alguno de los productos ya no esta disponible."}, status=400
+            )
+
         cart_record = Cart.objects.create(total_price=Decimal(serialized["total"]))
         cart_items: List[CartItem] = []
+        purchase_items: List[Dict[str, object]] = []
         for item in serialized["items"]:
-            product = products[item["product_id"]]
+            product_id = item["product_id"]
             cart_items.append(
                 CartItem(
                     cart=cart_record,
-                    product=product,
+                    product_id=product_id,
                     quantity=item["quantity"],
                     unit_price=Decimal(item["unit_price"]),
                 )
             )
-        CartItem.objects.bulk_create(cart_items)
-
-    _save_session_cart(request, {})
+            purchase_items.append(
+                {
+                    "product": product_names[product_id],
+                    "product_id": product_id,
+                    "quantity": item["quantity"],
+                    "unit_price": item["unit_price"],
+                    "line_total": item["line_total"],
+                }
+            )
+        CartItem.objects.bulk_create(cart_items, batch_size=CART_ITEMS_BATCH_SIZE)
 
-    purchases = _recent_purchases()
-    return JsonResponse(
+    return _json_response(
         {
             "status": "ok",
             "detail": "Compra registrada correctamente.",
-            "purchase": _serialize_purchase(cart_record),
-            "cart": _serialize_cart({}),
-            "purchases": purchases,
+            "purchase": _serialize_purchase(cart_record, items=purchase_items),
+            "cart": _save_and_serialize_cart(request, {}),
         }
     )
 
 
 @require_GET
 def purchase_list(request):
-    return JsonResponse(
+    return _json_response(
         {
             "status": "ok",
             "purchases": _recent_purchases(),
@@ -368,7 +469,7 @@ def purchase_list(request):
 def purchase_delete(request, pk: int):
     purchase = get_object_or_404(Cart, pk=pk)
     purchase.delete()
-    return JsonResponse(
+    return _json_response(
         {
             "status": "ok",
             "detail": "Compra eliminada correctamente.",
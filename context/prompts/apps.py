@@ -5,3 +5,6 @@ class ContextPromptsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'context.prompts'
     label = 'context_prompts'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -2,11 +2,20 @@
 
 from __future__ import annotations
 
-from typing import List, Sequence
+from typing import Dict, List, Sequence
+
+from django.db.models import Q, Value
+from django.db.models.functions import Lower
+from django.utils import timezone
 
 from core.products.models import Category, Product
 
-from .common import PromptPendingAction, PromptServiceError
+from .common import PromptPendingAction, PromptServiceError, bump_catalog_version, match_names
+
+CATEGORY_LINKS_BATCH_SIZE = 1000
+# Enough to link, unlink, delete and describe a category without loading
+# its description and timestamps.
+_CATEGORY_REF_FIELDS = ("id", "name", "slug")
 
 
 class CategoryCommandMixin:
@@ -16,10 +25,8 @@ class CategoryCommandMixin:
 
     def _handle_list_categories(self, data: dict) -> dict:
         self._parse_bool(data.get("include_products"), default=True)
-        categories = (
-            Category.objects.all()
-            .order_by("name")
-            .prefetch_related("products")
+        categories = list(
+            Category.objects.order_by("name").values_list("id", "name", "slug", "is_active")
         )
         if not categories:
             return {
@@ -27,15 +34,13 @@ class CategoryCommandMixin:
                 "answer": "No hay categorias registradas.",
             }
 
-        lines: List[str] = []
-        for category in categories:
-            status = "activa" if category.is_active else "inactiva"
-            line = f"- id={category.id}, nombre={category.name}, slug={category.slug}, estado={status}"
-            lines.append(line)
-
         return {
             "detail": "Categorias consultadas.",
-            "answer": "\n".join(lines),
+            "answer": "\n".join(
+                f"- id={category_id}, nombre={name}, slug={slug}, "
+                f"estado={'activa' if is_active else 'inactiva'}"
+                for category_id, name, slug, is_active in categories
+            ),
         }
 
     def _handle_create_category(self, data: dict) -> dict:
@@ -48,12 +53,9 @@ class CategoryCommandMixin:
                 field_label="name",
             )
         except PromptServiceError as exc:
-            pending_data = dict(data)
-            pending_data.pop("confirm", None)
-            pending_data.pop("confirmation", None)
             raise PromptPendingAction(
                 "Falta el nombre de la categoria.",
-                command={"action": "create_category", "data": pending_data},
+                command={"action": "create_category", "data": self._without_confirmation(data)},
                 requirements=[
                     {
                         "field": "name",
@@ -159,12 +161,26 @@ class CategoryCommandMixin:
                 "answer": "No se detectaron cambios para aplicar en la categoria.",
             }
 
+        # Validate only the changed fields. The slug is already unique by
+        # construction, so the name is the only field needing a unique lookup.
+        unchanged = [
+            field.name for field in Category._meta.concrete_fields if field.name not in django_fields
+        ]
         try:
-            category.full_clean()
+            category.clean_fields(exclude=unchanged)
+            if "name" in django_fields:
+                category.validate_unique(exclude=unchanged + ["slug"])
         except Exception as exc:  # ValidationError
             raise PromptServiceError(self._format_validation_error(exc)) from exc
 
-        category.save(update_fields=django_fields)
+        # QuerySet.update() skips auto_now and the model signals, so set
+        # updated_at and bump the catalog context version explicitly.
+        category.updated_at = timezone.now()
+        Category.objects.filter(pk=category.id).update(
+            updated_at=category.updated_at,
+            **{field: getattr(category, field) for field in django_fields},
+        )
+        bump_catalog_version()
 
         return {
             "detail": "Categoria actualizada.",
@@ -174,7 +190,7 @@ class CategoryCommandMixin:
         }
 
     def _handle_delete_category(self, data: dict) -> dict:
-        category = self._resolve_category(data)
+        category = self._resolve_category(data, fields=_CATEGORY_REF_FIELDS)
 
         confirm_detail = f"Confirma la eliminacion de la categoria '{category.name}'."
         confirm_prompt = f"¿Deseas eliminar la categoria '{category.name}'?"
@@ -194,7 +210,7 @@ class CategoryCommandMixin:
 
     def _handle_assign_category(self, data: dict) -> dict:
         product = self._resolve_product(data)
-        category = self._resolve_category(data)
+        category = self._resolve_category(data, fields=_CATEGORY_REF_FIELDS)
         product.categories.add(category)
         return {
             "detail": "Categoria asignada.",
@@ -202,27 +218,40 @@ class CategoryCommandMixin:
         }
 
     def _handle_assign_category_to_all_products(self, data: dict) -> dict:
-        category = self._resolve_category(data)
-        products = list(Product.objects.all().order_by("id"))
-        if not products:
+        category = self._resolve_category(data, fields=_CATEGORY_REF_FIELDS)
+        product_ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+        if not product_ids:
             return {
                 "detail": "Categoria asignada a todos.",
                 "answer": "No hay productos para asignar a la categoria.",
             }
 
-        for product in products:
-            product.categories.add(category)
+        through = Product.categories.through
+        existing = set(
+            through.objects.filter(category=category).values_list("product_id", flat=True)
+        )
+        through.objects.bulk_create(
+            [
+                through(product_id=product_id, category_id=category.id)
+                for product_id in product_ids
+                if product_id not in existing
+            ],
+            batch_size=CATEGORY_LINKS_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        # bulk_create() on the link table does not send m2m_changed.
+        bump_catalog_version()
 
         return {
             "detail": "Categoria asignada a todos.",
             "answer": (
-                f"Categoria {category.name} asignada a {len(products)} producto(s)."
+                f"Categoria {category.name} asignada a {len(product_ids)} producto(s)."
             ),
         }
 
     def _handle_unassign_category(self, data: dict) -> dict:
         product = self._resolve_product(data)
-        category = self._resolve_category(data)
+        category = self._resolve_category(data, fields=_CATEGORY_REF_FIELDS)
         product.categories.remove(category)
         return {
             "detail": "Categoria desasignada.",
@@ -236,14 +265,16 @@ class CategoryCommandMixin:
             return []
         if isinstance(value, str):
             tokens = [token.strip() for token in value.split(",") if token.strip()]
-        elif isinstance(value, Sequence):
+        elif isinstance(value, (list, tuple)):
             tokens = value
         else:
             raise PromptServiceError(
                 "El campo 'categories' debe ser una cadena o una lista."
             )
 
-        categories: List[Category] = []
+        # Classify every token first (same rules as _resolve_category and
+        # _resolve_category_token), then resolve them all with two queries.
+        lookups: List[tuple[str, object]] = []
         for token in tokens:
             if isinstance(token, dict):
                 candidate = {}
@@ -257,56 +288,119 @@ class CategoryCommandMixin:
                     raise PromptServiceError(
                         "No se pudo interpretar una categoria de la lista proporcionada."
                     )
-                category = self._resolve_category(candidate)
+                identifier = (
+                    candidate.get("category_id")
+                    if "category_id" in candidate
+                    else candidate.get("category_slug")
+                )
+                if identifier is None:
+                    if "category_name" not in candidate:
+                        raise PromptServiceError(
+                            "No se proporciono informacion suficiente de la categoria."
+                        )
+                    name = (candidate.get("category_name") or "").strip()
+                    if not name:
+                        raise PromptServiceError("El 'name' de la categoria no puede estar vacio.")
+                    lookups.append(("name", name))
+                    continue
+                token = identifier
+            lookups.append(self._classify_category_token(token))
+
+        ids = {key for kind, key in lookups if kind == "id"}
+        texts = {key for kind, key in lookups if kind == "text"}
+        names = {key for kind, key in lookups if kind in ("text", "name")}
+        queryset = Category.objects.only(*_CATEGORY_REF_FIELDS)
+        by_id = queryset.in_bulk(ids) if ids else {}
+        by_slug: Dict[str, Category] = {}
+        by_name: Dict[str, Category] = {}
+        if names:
+            rows, matches = match_names(queryset, names, extra=Q(slug__in=texts))
+            by_slug = {category.slug: category for category in rows}
+            by_name = {name: found[0] for name, found in matches.items()}
+
+        categories: List[Category] = []
+        for kind, key in lookups:
+            if kind == "id":
+                category = by_id.get(key)
+                if category is None:
+                    raise PromptServiceError(f"Categoria con id={key} no existe.")
+            elif kind == "text":
+                category = by_slug.get(key) or by_name.get(key)
+                if category is None:
+                    raise PromptServiceError(f"Categoria '{key}' no existe.")
             else:
-                category = self._resolve_category_token(token)
+                category = by_name.get(key)
+                if category is None:
+                    raise PromptServiceError(f"La categoria '{key}' no existe.")
             categories.append(category)
         return categories
 
-    def _resolve_category(self, data: dict, prefix: str = "category") -> Category:
+    def _classify_category_token(self, token) -> tuple[str, object]:
+        if isinstance(token, int):
+            return "id", token
+        text = str(token).strip()
+        if not text:
+            raise PromptServiceError("Identificador de categoria vacio.")
+        if text.isdigit():
+            return "id", int(text)
+        return "text", text
+
+    def _resolve_category(
+        self,
+        data: dict,
+        prefix: str = "category",
+        *,
+        fields: Sequence[str] | None = None,
+    ) -> Category:
+        queryset = Category.objects.only(*fields) if fields else Category.objects.all()
         identifier = (
             data.get(f"{prefix}_id")
             if f"{prefix}_id" in data
             else data.get(f"{prefix}_slug")
         )
         if identifier is not None:
-            return self._resolve_category_token(identifier)
+            return self._resolve_category_token(identifier, queryset=queryset)
 
         if f"{prefix}_name" in data:
             name = (data.get(f"{prefix}_name") or "").strip()
             if not name:
                 raise PromptServiceError("El 'name' de la categoria no puede estar vacio.")
-            try:
-                return Category.objects.get(name__iexact=name)
-            except Category.DoesNotExist as exc:
-                raise PromptServiceError(f"La categoria '{name}' no existe.") from exc
+            category = (
+                queryset.annotate(name_lower=Lower("name"))
+                .filter(name_lower=Lower(Value(name)))
+                .first()
+            )
+            if category is None:
+                raise PromptServiceError(f"La categoria '{name}' no existe.")
+            return category
 
         raise PromptServiceError("No se proporciono informacion suficiente de la categoria.")
 
-    def _resolve_category_token(self, token) -> Category:
-        if isinstance(token, int):
-            try:
-                return Category.objects.get(id=token)
-            except Category.DoesNotExist as exc:
-                raise PromptServiceError(f"Categoria con id={token} no existe.") from exc
-
-        text = str(token).strip()
-        if not text:
-            raise PromptServiceError("Identificador de categoria vacio.")
-
-        if text.isdigit():
-            try:
-                return Category.objects.get(id=int(text))
-            except Category.DoesNotExist as exc:
-                raise PromptServiceError(f"Categoria con id={text} no existe.") from exc
-
-        try:
-            return Category.objects.get(slug=text)
-        except Category.DoesNotExist:
-            try:
-                return Category.objects.get(name__iexact=text)
-            except Category.DoesNotExist as exc:
-                raise PromptServiceError(f"Categoria '{text}' no existe.") from exc
+    def _resolve_category_token(self, token, *, queryset=None) -> Category:
+        if queryset is None:
+            queryset = Category.objects.all()
+        kind, key = self._classify_category_token(token)
+        if kind == "id":
+            category = queryset.filter(id=key).first()
+            if category is None:
+                raise PromptServiceError(f"Categoria con id={key} no existe.")
+            return category
+
+        text = key
+
+        # Slug and name are unique, so this returns at most a couple of rows;
+        # an exact slug match wins over a name match, as before.
+        matches = list(
+            queryset.annotate(name_lower=Lower("name")).filter(
+                Q(slug=text) | Q(name_lower=Lower(Value(text)))
+            )
+        )
+        for category in matches:
+            if category.slug == text:
+                return category
+        if matches:
+            return matches[0]
+        raise PromptServiceError(f"Categoria '{text}' no existe.")
 
 
 __all__ = ["CategoryCommandMixin"]
@@ -2,15 +2,88 @@
 
 from __future__ import annotations
 
+import json
 import logging
-from typing import Any, List
+import re
+import time
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
 
 import requests
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q, QuerySet, Value
+from django.db.models.functions import Lower
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:  # orjson is an optional accelerator; fall back to the standard library.
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+# Regex fragments shared by the processor prefilter and the interpreter, so
+# both agree on what looks like a write instruction.
+COMMAND_VERBS: Tuple[str, ...] = (
+    "crea", "borra", "elimina", "asigna", "desasigna", "actualiza", "modifica",
+    "cambia", "renombra", "agrega", "a[nñ]ade", "quita", "retira", "registra",
+    "compra", "activa", "desactiva", "pon", "sube", "baja", "vende", "mete",
+    "mueve", "aumenta", "reduce", "create", "delete", "remove", "update",
+    "assign", "add", "set", "rename", "activate", "deactivate", "sell", "buy",
+)
+COMMAND_NOUNS: Tuple[str, ...] = (
+    "producto", "categor", "stock", "precio", "product", "category", "price",
+    "purchase",
+)
+READ_ONLY_WORDS: Tuple[str, ...] = (
+    "lista", "listar", "muestra", "mostrar", "cuant", "cual", "consulta",
+    "list", "show", "how many", "which",
+)
+
+
+def keyword_regex(words: Sequence[str]) -> re.Pattern[str]:
+    """Compile a case-insensitive regex matching any word prefix in ``words``."""
+
+    return re.compile(r"\b(?:" + "|".join(words) + ")", re.IGNORECASE)
+
 
 GROQ_CHAT_URL = "https://api.groq.com/openai/v1/chat/completions"
+CATALOG_VERSION_CACHE_KEY = "prompt_catalog_version"
+PURCHASES_VERSION_CACHE_KEY = "prompt_purchases_version"
 LOG = logging.getLogger(__name__)
 
 
+def build_groq_session() -> requests.Session:
+    """Return a pooled session that keeps connections to Groq alive between calls."""
+
+    retries = Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries),
+    )
+    return session
+
+
+GROQ_SESSION = build_groq_session()
+
+# Both parsers raise a json.JSONDecodeError subclass on invalid input.
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def json_dumps(payload: Any) -> bytes:
+    """Serialize ``payload`` to UTF-8 encoded JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
 class PromptServiceError(Exception):
     """Raised when the prompt service cannot produce an answer."""
 
@@ -36,11 +109,110 @@ class PromptActionCancelled(PromptServiceError):
     """Raised when the user declines to continue with the pending action."""
 
 
+OrderingTable = Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]]
+
+
+def build_ordering_table(allowed_fields: Dict[str, str | Sequence[str]]) -> OrderingTable:
+    """Map each accepted order key to its ascending and descending field lists."""
+
+    table: OrderingTable = {}
+    for key, resolved in allowed_fields.items():
+        fields = [resolved] if isinstance(resolved, str) else list(resolved)
+        names = tuple(field.lstrip("+-") for field in fields)
+        table[key] = (names, tuple(f"-{name}" for name in names))
+    return table
+
+
+def normalize_commands(commands: List[Any]) -> List[dict]:
+    """Validate raw command entries and normalize their action names."""
+
+    normalized: List[dict] = []
+    for entry in commands:
+        if not isinstance(entry, dict):
+            raise PromptServiceError("Cada comando debe ser un objeto JSON.")
+        action = str(entry.get("action") or "").strip().lower()
+        if not action:
+            raise PromptServiceError("Cada comando debe especificar el campo 'action'.")
+        data_block = entry.get("data") or {}
+        if not isinstance(data_block, dict):
+            raise PromptServiceError("El campo 'data' de cada comando debe ser un objeto.")
+        normalized.append({"action": action, "data": data_block})
+    return normalized
+
+
+def match_names(
+    queryset: QuerySet, names: Iterable[str], *, extra: Q | None = None
+) -> Tuple[List[Any], Dict[str, List[Any]]]:
+    """Fetch the rows whose name matches any of ``names`` ignoring case.
+
+    The column and every name are both lowered by the database, so names
+    match the way ``Lower("name")`` folds them even where LOWER() only handles
+    ASCII. ``extra`` is OR-ed into the same query. Returns the rows and a
+    mapping from each requested name to the rows it matched.
+    """
+
+    aliases = {f"lookup_{index}": name for index, name in enumerate(dict.fromkeys(names))}
+    condition = extra
+    for alias in aliases:
+        term = Q(name_lower=F(alias))
+        condition = term if condition is None else condition | term
+    if condition is None:
+        return [], {}
+
+    rows = list(
+        queryset.annotate(
+            name_lower=Lower("name"),
+            **{alias: Lower(Value(name)) for alias, name in aliases.items()},
+        ).filter(condition)
+    )
+    matches: Dict[str, List[Any]] = {}
+    for row in rows:
+        for alias, name in aliases.items():
+            if getattr(row, alias) == row.name_lower:
+                matches.setdefault(name, []).append(row)
+    return rows, matches
+
+
+def catalog_version(*, include_purchases: bool = False) -> str:
+    """Return the cache version of the catalog, and of purchases if requested.
+
+    Reading it is a single cache lookup. The model signals in
+    ``context.prompts.signals`` and writes that bypass them call
+    ``bump_catalog_version``, so cached contexts built from an older version are
+    never read again by this process.
+    """
+
+    keys = [CATALOG_VERSION_CACHE_KEY]
+    if include_purchases:
+        keys.append(PURCHASES_VERSION_CACHE_KEY)
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Start from the clock so a cleared cache never reuses an old version.
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return ":".join(str(versions[key]) for key in keys)
+
+
+def bump_catalog_version(*, purchases: bool = False) -> None:
+    """Invalidate the cached catalog (or purchases) contexts after the transaction commits."""
+
+    key = PURCHASES_VERSION_CACHE_KEY if purchases else CATALOG_VERSION_CACHE_KEY
+    transaction.on_commit(lambda: _bump_version(key))
+
+
+def _bump_version(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:  # Not read yet; the next read starts a new version.
+        pass
+
+
 def extract_error_detail(response: requests.Response) -> str:
     """Return the most relevant error detail from a Groq response."""
 
     try:
-        payload: Any = response.json()
+        payload: Any = json_loads(response.content)
     except ValueError:
         text = response.text.strip()
         return text or "Respuesta vacia."
@@ -3,27 +3,85 @@
 from __future__ import annotations
 
 import json
-from typing import List
+import re
+from collections import defaultdict
+from itertools import chain
+from typing import Dict, List
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
 
 from core.cart.models import Cart
 from core.products.models import Category, Product
 
-from .common import GROQ_CHAT_URL, LOG, PromptServiceError, extract_error_detail
+from .common import (
+    COMMAND_VERBS,
+    GROQ_CHAT_URL,
+    GROQ_SESSION,
+    LOG,
+    PromptServiceError,
+    READ_ONLY_WORDS,
+    catalog_version,
+    extract_error_detail,
+    json_dumps,
+    json_loads,
+    keyword_regex,
+    normalize_commands,
+)
+
+_SYSTEM_PROMPT = (
+    "Eres un asistente que transforma instrucciones en espanol en una lista JSON de comandos "
+    "para gestionar productos, categorias y compras. Devuelve exclusivamente un objeto JSON "
+    "con la forma {\"commands\": [...]} sin explicaciones adicionales. Las acciones validas son: "
+    "list_categories, create_category, update_category, delete_category, assign_category, assign_category_to_all_products, "
+    "unassign_category, list_products, create_product, update_product, delete_product, product_metrics, "
+    "list_purchases, create_purchase, delete_purchase, delete_purchases_by_product y purchase_metrics. Para cada comando incluye "
+    "en 'data' los campos minimos necesarios:\n"
+    "- create_category: siempre 'name' y opcionalmente 'slug'.\n"
+    "- update_category: identifica la categoria y permite cambiar 'name', 'slug', 'description' o 'is_active'.\n"
+    "- assign_category/assign_category_to_all_products/unassign_category: identifica la categoria "
+    "por 'category_id', 'category_slug' o 'category_name'.\n"
+    "- list_products: permite 'order_by' (price|name), 'direction' (asc|desc) y banderas como "
+    "'include_categories'.\n"
+    "- create_product: requiere 'name', 'price' y 'stock'.\n"
+    "- update_product/delete_product: identifica el producto con 'product_id', 'product_slug' o 'product_name'. "
+    "Para actualizacion puedes incluir campos como 'price', 'stock', 'is_active', 'categories', "
+    "'assign_categories' y 'remove_categories'.\n"
+    "- product_metrics: usa 'metrics' (lista con valores como 'max_price' o 'min_price').\n"
+    "- list_purchases: acepta 'order_by' (total_price|name) y 'direction'.\n"
+    "- create_purchase: proporciona 'items', cada uno con 'product_id' o 'product_slug' y 'quantity'.\n"
+    "- delete_purchase: identifica la compra mediante 'purchase_id'.\n"
+    "- delete_purchases_by_product: identifica el producto y elimina todas las compras relacionadas.\n"
+    "- purchase_metrics: usa 'metrics' (max_price|min_price|max_items|min_items).\n"
+    "Si la instruccion no corresponde a estas operaciones responde {\"commands\": []}."
+)
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+_USER_PROMPT_PREFIX = "Inventario actual:\n"
+_INSTRUCTION_PREFIX = "Instruccion: "
+
+# Write instructions need the inventory to pick ids and slugs. Anything that is
+# not clearly a read-only listing or metric gets it too, so an unusual verb
+# never reaches the model without the rows it has to reference.
+_WRITE_VERB_RE = keyword_regex(COMMAND_VERBS)
+_READ_ONLY_RE = keyword_regex(READ_ONLY_WORDS)
+
+INVENTORY_CONTEXT_CACHE_PREFIX = "prompt_inventory_context:v2"
+INVENTORY_CONTEXT_CACHE_TIMEOUT = 60
+INVENTORY_CONTEXT_MAX_ROWS = 50
+INTERPRETER_MAX_CONTENT_CHARS = 8192
+
+
+_CODE_FENCE_RE = re.compile(r"\A```(?:json)?\s*(.*?)\s*(?:```)?\Z", re.DOTALL | re.IGNORECASE)
 
 
 def _strip_code_fence(content: str) -> str:
     """Remove optional Markdown code fences from the LLM response."""
 
     cleaned = content.strip()
-    if cleaned.startswith("```"):
-        if cleaned.startswith("```json"):
-            cleaned = cleaned[len("```json") :].strip()
-        if cleaned.endswith("```"):
-            cleaned = cleaned[:-3].strip()
-    return cleaned
+    match = _CODE_FENCE_RE.match(cleaned)
+    return match.group(1) if match else cleaned
 
 
 class PromptCommandInterpreter:
@@ -31,7 +89,11 @@ class PromptCommandInterpreter:
 
     def __init__(self, api_key: str | None = None, model: str | None = None) -> None:
         self.api_key = (api_key or getattr(settings, "GROQ_API_KEY", "")).strip()
-        self.model = (model or getattr(settings, "GROQ_MODEL", "")).strip()
+        self.model = (model or getattr(settings, "GROQ_MODEL", "")).strip() or "llama3-70b-8192"
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
 
     def translate(self, message: str) -> List[dict]:
         prompt = (message or "").strip()
@@ -43,64 +105,33 @@ class PromptCommandInterpreter:
                 "No se pudo interpretar el comando de forma automatica. Envialo como JSON o configura GROQ_API_KEY."
             )
 
-        inventory_context = self._build_inventory_context()
+        if _WRITE_VERB_RE.search(prompt) or not _READ_ONLY_RE.search(prompt):
+            user_content = (
+                _USER_PROMPT_PREFIX
+                + self._build_inventory_context()
+                + "\n\n"
+                + _INSTRUCTION_PREFIX
+                + prompt
+            )
+        else:
+            user_content = _INSTRUCTION_PREFIX + prompt
         payload = {
-            "model": self.model or "llama3-70b-8192",
+            "model": self.model,
             "messages": [
-                {
-                    "role": "system",
-                    "content": (
-                        "Eres un asistente que transforma instrucciones en espanol en una lista JSON de comandos "
-                        "para gestionar productos, categorias y compras. Devuelve exclusivamente un objeto JSON "
-                        "con la forma {\"commands\": [...]} sin explicaciones adicionales. Las acciones validas son: "
-                        "list_categories, create_category, update_category, delete_category, assign_category, assign_category_to_all_products, "
-                        "unassign_category, list_products, create_product, update_product, delete_product, product_metrics, "
-                        "list_purchases, create_purchase, delete_purchase, delete_purchases_by_product y purchase_metrics. Para cada comando incluye "
-                        "en 'data' los campos minimos necesarios:\n"
-                        "- create_category: siempre 'name' y opcionalmente 'slug'.\n"
-                        "- update_category: identifica la categoria y permite cambiar 'name', 'slug', 'description' o 'is_active'.\n"
-                        "- assign_category/assign_category_to_all_products/unassign_category: identifica la categoria "
-                        "por 'category_id', 'category_slug' o 'category_name'.\n"
-                        "- list_products: permite 'order_by' (price|name), 'direction' (asc|desc) y banderas como "
-                        "'include_categories'.\n"
-                        "- create_product: requiere 'name', 'price' y 'stock'.\n"
-                        "- update_product/delete_product: identifica el producto con 'product_id', 'product_slug' o 'product_name'. "
-                        "Para actualizacion puedes incluir campos como 'price', 'stock', 'is_active', 'categories', "
-                        "'assign_categories' y 'remove_categories'.\n"
-                        "- product_metrics: usa 'metrics' (lista con valores como 'max_price' o 'min_price').\n"
-                        "- list_purchases: acepta 'order_by' (total_price|name) y 'direction'.\n"
-                        "- create_purchase: proporciona 'items', cada uno con 'product_id' o 'product_slug' y 'quantity'.\n"
-                        "- delete_purchase: identifica la compra mediante 'purchase_id'.\n"
-                        "- delete_purchases_by_product: identifica el producto y elimina todas las compras relacionadas.\n"
-                        "- purchase_metrics: usa 'metrics' (max_price|min_price|max_items|min_items).\n"
-                        "Si la instruccion no corresponde a estas operaciones responde {\"commands\": []}."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        "Inventario actual:\n"
-                        + inventory_context
-                        + "\n\nInstruccion: "
-                        + prompt
-                    ),
-                },
+                _SYSTEM_MESSAGE,
+                {"role": "user", "content": user_content},
             ],
             "temperature": 0.1,
             "max_tokens": 256,
         }
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-
         try:
-            response = requests.post(
+            response = GROQ_SESSION.post(
                 GROQ_CHAT_URL,
-                json=payload,
-                headers=headers,
+                data=json_dumps(payload),
+                headers=self._headers,
                 timeout=30,
+                stream=True,
             )
         except requests.RequestException as exc:
             LOG.exception("Groq interpreter request failed")
@@ -109,15 +140,20 @@ class PromptCommandInterpreter:
             ) from exc
 
         if response.status_code >= 400:
-            detail = extract_error_detail(response)
+            # Reading the body before closing hands the connection back to the
+            # pooled session instead of discarding it.
+            try:
+                detail = extract_error_detail(response)
+            finally:
+                response.close()
             LOG.error("Groq interpreter error %s: %s", response.status_code, detail)
             raise PromptServiceError(
                 f"Error al interpretar el comando ({response.status_code}): {detail}"
             )
 
         try:
-            data = response.json()
-        except ValueError as exc:
+            data = json_loads(b"".join(response.iter_content(chunk_size=65536)))
+        except (ValueError, requests.RequestException) as exc:
             raise PromptServiceError("Respuesta invalida del interprete LLM.") from exc
 
         choices = data.get("choices") or []
@@ -129,9 +165,13 @@ class PromptCommandInterpreter:
             return []
 
         content = _strip_code_fence(content)
+        # Only a {"commands": [...]} object is accepted; reject prose and
+        # runaway replies before handing them to the parser.
+        if not content.startswith("{") or len(content) > INTERPRETER_MAX_CONTENT_CHARS:
+            raise PromptServiceError("La respuesta del interprete no es JSON valido.")
 
         try:
-            parsed = json.loads(content)
+            parsed = json_loads(content)
         except json.JSONDecodeError as exc:
             raise PromptServiceError("La respuesta del interprete no es JSON valido.") from exc
 
@@ -141,78 +181,80 @@ class PromptCommandInterpreter:
         if not isinstance(commands, list):
             raise PromptServiceError("El interprete devolvio un formato de comandos invalido.")
 
-        normalized: List[dict] = []
-        for entry in commands:
-            if not isinstance(entry, dict):
-                raise PromptServiceError("Cada comando debe ser un objeto JSON.")
-            action = str(entry.get("action") or "").strip().lower()
-            if not action:
-                raise PromptServiceError("Falta la accion en uno de los comandos interpretados.")
-            data_block = entry.get("data") or {}
-            if not isinstance(data_block, dict):
-                raise PromptServiceError("El bloque 'data' del comando debe ser un objeto JSON.")
-            normalized.append({"action": action, "data": data_block})
-
-        return normalized
+        return normalize_commands(commands)
 
     def _build_inventory_context(self) -> str:
-        products = (
-            Product.objects.all()
-            .order_by("id")
-            .prefetch_related("categories")
-        )
-        categories = (
-            Category.objects.all()
-            .order_by("id")
-            .prefetch_related("products")
+        # Keyed on the catalog and purchase versions, so writes from prompt
+        # commands, cart checkout or the admin produce a fresh context.
+        cache_key = (
+            f"{INVENTORY_CONTEXT_CACHE_PREFIX}:{catalog_version(include_purchases=True)}"
         )
-        purchases = (
-            Cart.objects.all()
-            .prefetch_related("items__product")
-            .order_by("-created_at")[:20]
+        context = cache.get(cache_key)
+        if context is None:
+            context = self._load_inventory_context()
+            cache.set(cache_key, context, INVENTORY_CONTEXT_CACHE_TIMEOUT)
+        return context
+
+    def _load_inventory_context(self) -> str:
+        # Only the newest rows are sent; older ones are summarized by a count.
+        limit = INVENTORY_CONTEXT_MAX_ROWS
+        products = list(Product.objects.order_by("-id").values_list("id", "name", "slug")[:limit])
+        products.reverse()
+        categories = list(Category.objects.order_by("-id").values_list("id", "name", "slug")[:limit])
+        categories.reverse()
+        hidden_products = Product.objects.count() - limit if len(products) == limit else 0
+        hidden_categories = Category.objects.count() - limit if len(categories) == limit else 0
+
+        links = Product.categories.through.objects.all()
+        category_names: Dict[int, List[str]] = defaultdict(list)
+        for product_id, category_name in (
+            links.filter(product_id__in=[row[0] for row in products])
+            .order_by("category__name")
+            .values_list("product_id", "category__name")
+        ):
+            category_names[product_id].append(category_name)
+        product_names: Dict[int, List[str]] = defaultdict(list)
+        for category_id, product_name in (
+            links.filter(category_id__in=[row[0] for row in categories])
+            .order_by("product__name")
+            .values_list("category_id", "product__name")
+        ):
+            product_names[category_id].append(product_name)
+
+        purchases = list(
+            Cart.objects.annotate(total_items=Sum("items__quantity"))
+            .order_by("-created_at")
+            .values_list("id", "total_price", "total_items")[:20]
         )
 
         product_lines: List[str] = [
             "Productos actuales:" if products else "Productos actuales: ninguno"
         ]
-        for product in products:
-            product_lines.append(
-                (
-                    f"- id={product.id}, nombre={product.name}, slug={product.slug}, categorias="
-                    + (
-                        ", ".join(
-                            category.name for category in product.categories.all().order_by("name")
-                        )
-                        or "sin categorias"
-                    )
-                )
-            )
+        product_lines.extend(
+            f"- id={product_id}, nombre={name}, slug={slug}, "
+            f"categorias={', '.join(category_names[product_id]) or 'sin categorias'}"
+            for product_id, name, slug in products
+        )
+        if hidden_products:
+            product_lines.append(f"- (... y {hidden_products} productos mas)")
 
         category_lines: List[str] = [
             "Categorias actuales:" if categories else "Categorias actuales: ninguna"
         ]
-        for category in categories:
-            category_lines.append(
-                (
-                    f"- id={category.id}, nombre={category.name}, slug={category.slug}, productos="
-                    + (
-                        ", ".join(
-                            product.name for product in category.products.all().order_by("name")
-                        )
-                        or "sin productos"
-                    )
-                )
-            )
+        category_lines.extend(
+            f"- id={category_id}, nombre={name}, slug={slug}, "
+            f"productos={', '.join(product_names[category_id]) or 'sin productos'}"
+            for category_id, name, slug in categories
+        )
+        if hidden_categories:
+            category_lines.append(f"- (... y {hidden_categories} categorias mas)")
 
         purchase_lines: List[str] = [
             "Compras recientes:" if purchases else "Compras recientes: ninguna"
         ]
-        for purchase in purchases:
-            item_count = sum(item.quantity for item in purchase.items.all())
-            purchase_lines.append(
-                (
-                    f"- id={purchase.id}, total={purchase.total_price}, articulos={item_count}"
-                )
-            )
+        purchase_lines.extend(
+            f"- id={purchase_id}, total={total_price}, articulos={total_items or 0}"
+            for purchase_id, total_price, total_items in purchases
+        )
 
-        return "\n".join(product_lines + [""] + category_lines + [""] + purchase_lines)
+        return "\n".join(chain(product_lines, ("",), category_lines, ("",), purchase_lines))
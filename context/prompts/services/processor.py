@@ -3,19 +3,28 @@
 from __future__ import annotations
 
 import json
+import re
 from datetime import datetime, time
 from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 from typing import TYPE_CHECKING, List, Sequence
 
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.dateparse import parse_date, parse_datetime
 
 from .common import (
+    COMMAND_NOUNS,
+    COMMAND_VERBS,
+    OrderingTable,
     PromptActionCancelled,
     PromptPendingAction,
     PromptServiceError,
+    json_loads,
+    keyword_regex,
+    normalize_commands,
 )
 from .categories import CategoryCommandMixin
 from .products import ProductCommandMixin
@@ -25,7 +34,7 @@ if TYPE_CHECKING:  # pragma: no cover - imported only for type checking
     from .interpreter import PromptCommandInterpreter
 
 
-WRITE_ACTIONS = {
+WRITE_ACTIONS = frozenset({
     "create_category",
     "delete_category",
     "update_category",
@@ -38,8 +47,55 @@ WRITE_ACTIONS = {
     "create_purchase",
     "delete_purchase",
     "delete_purchases_by_product",
+})
+
+_BOOL_TRUE = frozenset({"true", "1", "yes", "y", "si", "on"})
+_BOOL_FALSE = frozenset({"false", "0", "no", "off"})
+_DIRECTION_ALIASES = {
+    "asc": "asc",
+    "ascendente": "asc",
+    "ascending": "asc",
+    "desc": "desc",
+    "descendente": "desc",
+    "descending": "desc",
 }
 
+_HELP_MESSAGE = (
+    "Comandos JSON disponibles:\n"
+    '- Listar categorias: {"action": "list_categories"}\n'
+    '- Crear categoria: {"action": "create_category", "data": {"name": "Snacks"}}\n'
+    '- Actualizar categoria: {"action": "update_category", "data": {"category_slug": "snacks", "name": "Bebidas"}}\n'
+    '- Eliminar categoria por id: {"action": "delete_category", "data": {"category_id": 3}}\n'
+    '- Asignar categoria: {"action": "assign_category", "data": {"product_id": 1, "category_id": 3}}\n'
+    '- Asignar categoria a todos: {"action": "assign_category_to_all_products", "data": {"category_id": 3}}\n'
+    '- Desasignar categoria: {"action": "unassign_category", "data": {"product_id": 1, "category_id": 3}}\n'
+    '- Listar productos: {"action": "list_products"}\n'
+    '- Crear producto: {"action": "create_product", "data": {"name": "Cafe", "price": "9.99", "stock": 10}}\n'
+    '- Actualizar producto: {"action": "update_product", "data": {"product_id": 1, "price": "12.50"}}\n'
+    '- Eliminar producto: {"action": "delete_product", "data": {"product_id": 1}}\n'
+    '- Metricas de productos: {"action": "product_metrics", "data": {"metrics": ["max_price", "min_price"]}}\n'
+    '- Listar compras: {"action": "list_purchases", "data": {"order_by": "total", "direction": "desc", "start_date": "2024-01-01", "end_date": "2024-01-31", "min_price": "10.00", "product_slug": "cafe"}}\n'
+    '- Crear compra: {"action": "create_purchase", "data": {"items": [{"product_id": 1, "quantity": 2}]}}\n'
+    '- Eliminar compra: {"action": "delete_purchase", "data": {"purchase_id": 5, "confirm": true}}\n'
+    '- Eliminar compras por producto: {"action": "delete_purchases_by_product", "data": {"product_slug": "cafe", "confirm": true}}\n'
+    '- Metricas de compras: {"action": "purchase_metrics", "data": {"metrics": ["max_price", "max_items"]}}\n'
+    "Escribe 'help' para volver a ver esta lista."
+)
+
+_HELP_COMMANDS = frozenset({"help", "ayuda"})
+_HELP_COMMAND_MAX_LEN = max(len(command) for command in _HELP_COMMANDS)
+
+_CONFIRMATION_KEYS = frozenset({"confirm", "confirmation"})
+
+# Write commands always mention an action verb or one of the managed
+# entities; anything else is answered without asking the interpreter.
+_COMMAND_HINT_RE = keyword_regex(COMMAND_VERBS + COMMAND_NOUNS)
+
+
+@lru_cache(maxsize=1024)
+def _slugify(value: str) -> str:
+    return slugify(value)
+
 
 class PromptCommandProcessor(
     CategoryCommandMixin,
@@ -48,6 +104,28 @@ class PromptCommandProcessor(
 ):
     """Parse and execute structured commands sent through the prompt endpoint."""
 
+    # Action name -> handler method name; resolved per call with getattr so
+    # no bound-method table is built for every processor instance.
+    _HANDLERS = {
+        "list_categories": "_handle_list_categories",
+        "create_category": "_handle_create_category",
+        "delete_category": "_handle_delete_category",
+        "update_category": "_handle_update_category",
+        "assign_category": "_handle_assign_category",
+        "assign_category_to_all_products": "_handle_assign_category_to_all_products",
+        "unassign_category": "_handle_unassign_category",
+        "list_products": "_handle_list_products",
+        "create_product": "_handle_create_product",
+        "update_product": "_handle_update_product",
+        "delete_product": "_handle_delete_product",
+        "product_metrics": "_handle_product_metrics",
+        "list_purchases": "_handle_list_purchases",
+        "create_purchase": "_handle_create_purchase",
+        "delete_purchase": "_handle_delete_purchase",
+        "delete_purchases_by_product": "_handle_delete_purchases_by_product",
+        "purchase_metrics": "_handle_purchase_metrics",
+    }
+
     def __init__(self, interpreter: "PromptCommandInterpreter" | None = None) -> None:
         self.interpreter = interpreter
 
@@ -56,8 +134,8 @@ class PromptCommandProcessor(
         if not text:
             return None
 
-        lowered = text.lower()
-        if lowered in {"help", "ayuda"}:
+        # Only lowercase short messages; JSON bodies can be several KB long.
+        if len(text) <= _HELP_COMMAND_MAX_LEN and text.lower() in _HELP_COMMANDS:
             return {
                 "detail": "Comandos disponibles.",
                 "answer": self._build_help_message(),
@@ -65,7 +143,7 @@ class PromptCommandProcessor(
 
         if text.startswith("{"):
             try:
-                payload = json.loads(text)
+                payload = json_loads(text)
             except json.JSONDecodeError as exc:
                 raise PromptServiceError("El comando JSON es invalido.") from exc
 
@@ -79,22 +157,7 @@ class PromptCommandProcessor(
                         "El campo 'commands' debe ser una lista de objetos."
                     )
 
-                normalized: List[dict] = []
-                for entry in commands:
-                    if not isinstance(entry, dict):
-                        raise PromptServiceError("Cada comando debe ser un objeto JSON.")
-                    action = str(entry.get("action") or "").strip().lower()
-                    if not action:
-                        raise PromptServiceError(
-                            "Cada comando debe especificar el campo 'action'."
-                        )
-                    data_block = entry.get("data") or {}
-                    if not isinstance(data_block, dict):
-                        raise PromptServiceError(
-                            "El campo 'data' de cada comando debe ser un objeto."
-                        )
-                    normalized.append({"action": action, "data": data_block})
-
+                normalized = normalize_commands(commands)
                 if not normalized:
                     return {
                         "detail": "Sin comandos a ejecutar.",
@@ -119,64 +182,57 @@ class PromptCommandProcessor(
 
             return handler(data)
 
-        if self.interpreter is None:
+        if self.interpreter is None or not _COMMAND_HINT_RE.search(text):
             return None
 
         commands = self.interpreter.translate(text)
         if not commands:
             return None
 
-        has_writes = any(
-            (entry.get("action") or "").strip().lower() in WRITE_ACTIONS
-            for entry in commands
-        )
+        # translate() already returns normalized actions.
+        has_writes = any(entry["action"] in WRITE_ACTIONS for entry in commands)
         if not has_writes:
             return None
 
         return self._execute_sequence(commands)
 
     def _get_handler(self, action: str):
-        return {
-            "list_categories": self._handle_list_categories,
-            "create_category": self._handle_create_category,
-            "delete_category": self._handle_delete_category,
-            "update_category": self._handle_update_category,
-            "assign_category": self._handle_assign_category,
-            "assign_category_to_all_products": self._handle_assign_category_to_all_products,
-            "unassign_category": self._handle_unassign_category,
-            "list_products": self._handle_list_products,
-            "create_product": self._handle_create_product,
-            "update_product": self._handle_update_product,
-            "delete_product": self._handle_delete_product,
-            "product_metrics": self._handle_product_metrics,
-            "list_purchases": self._handle_list_purchases,
-            "create_purchase": self._handle_create_purchase,
-            "delete_purchase": self._handle_delete_purchase,
-            "delete_purchases_by_product": self._handle_delete_purchases_by_product,
-            "purchase_metrics": self._handle_purchase_metrics,
-        }.get(action.strip().lower())
+        """Return the bound handler for an already normalized action name."""
+
+        name = self._HANDLERS.get(action)
+        return getattr(self, name) if name is not None else None
 
     def _execute_sequence(self, commands: List[dict]) -> dict:
         answers: List[str] = []
         details: List[str] = []
+        interrupted: PromptServiceError | None = None
+
+        # Commit the whole batch at once; a failing command rolls back the
+        # ones before it. A command waiting for user input keeps the earlier
+        # ones, since only the pending command is sent back for confirmation.
+        with transaction.atomic():
+            # Entries come from normalize_commands, so every one already has
+            # a normalized action and a dict payload.
+            for command in commands:
+                action = command["action"]
+                handler = self._get_handler(action)
+                if handler is None:
+                    raise PromptServiceError(
+                        f"Accion desconocida en la secuencia: {action}."
+                    )
 
-        for command in commands:
-            action = command.get("action") or ""
-            data = command.get("data") or {}
-            if not isinstance(data, dict):
-                raise PromptServiceError("Cada comando debe incluir un objeto 'data'.")
-
-            handler = self._get_handler(str(action))
-            if handler is None:
-                raise PromptServiceError(
-                    f"Accion desconocida en la secuencia: {action}."
-                )
+                try:
+                    result = handler(command["data"])
+                except (PromptPendingAction, PromptActionCancelled) as exc:
+                    interrupted = exc
+                    break
+                details.append(result.get("detail") or "Comando ejecutado")
+                answer_text = result.get("answer")
+                if answer_text:
+                    answers.append(answer_text)
 
-            result = handler(data)
-            details.append(result.get("detail") or "Comando ejecutado")
-            answer_text = result.get("answer")
-            if answer_text:
-                answers.append(answer_text)
+        if interrupted is not None:
+            raise interrupted
 
         return {
             "detail": "; ".join(details) or "Comandos ejecutados.",
@@ -185,6 +241,9 @@ class PromptCommandProcessor(
 
     # Shared helpers ---------------------------------------------------
 
+    def _without_confirmation(self, data: dict) -> dict:
+        return {key: value for key, value in data.items() if key not in _CONFIRMATION_KEYS}
+
     def _ensure_confirmation(
         self,
         *,
@@ -198,24 +257,18 @@ class PromptCommandProcessor(
             confirm_value = data.get("confirmation")
 
         if confirm_value is None:
-            pending_data = dict(data)
-            pending_data.pop("confirm", None)
-            pending_data.pop("confirmation", None)
             raise PromptPendingAction(
                 detail,
-                command={"action": action, "data": pending_data},
+                command={"action": action, "data": self._without_confirmation(data)},
                 confirmation_message=prompt,
             )
 
         try:
             confirmed = self._parse_bool(confirm_value)
         except PromptServiceError as exc:
-            pending_data = dict(data)
-            pending_data.pop("confirm", None)
-            pending_data.pop("confirmation", None)
             raise PromptPendingAction(
                 detail,
-                command={"action": action, "data": pending_data},
+                command={"action": action, "data": self._without_confirmation(data)},
                 confirmation_message=prompt,
             ) from exc
 
@@ -234,10 +287,10 @@ class PromptCommandProcessor(
             return value
         if isinstance(value, (int, float)):
             return bool(value)
-        text = str(value).strip().lower()
-        if text in {"true", "1", "yes", "y", "si", "on"}:
+        text = (value if isinstance(value, str) else str(value)).strip().lower()
+        if text in _BOOL_TRUE:
             return True
-        if text in {"false", "0", "no", "off"}:
+        if text in _BOOL_FALSE:
             return False
         raise PromptServiceError(
             f"No se pudo interpretar el valor booleano: {value!r}."
@@ -248,8 +301,13 @@ class PromptCommandProcessor(
             if default is None:
                 raise PromptServiceError(f"El campo '{field}' es obligatorio.")
             value = default
+        # Floats still go through str() so 9.99 does not become its binary expansion.
+        if isinstance(value, (str, int, Decimal)) and not isinstance(value, bool):
+            raw = value
+        else:
+            raw = str(value)
         try:
-            return Decimal(str(value))
+            return Decimal(raw)
         except (InvalidOperation, TypeError) as exc:
             raise PromptServiceError(f"Valor invalido para '{field}'.") from exc
 
@@ -266,13 +324,19 @@ class PromptCommandProcessor(
     def _build_unique_slug(
         self, model, raw_slug: str, *, current_id: int | None = None
     ) -> str:
-        base_slug = slugify(raw_slug) or "item"
-        slug = base_slug
-        suffix = 1
-        queryset = model.objects.all()
+        base_slug = _slugify(raw_slug) or "item"
+        # The prefix filter can use the slug index; the regex then keeps only
+        # "base" and "base-N" so unrelated longer slugs are not fetched.
+        queryset = model.objects.filter(
+            slug__startswith=base_slug,
+            slug__regex=rf"^{re.escape(base_slug)}(-[0-9]+)?$",
+        )
         if current_id is not None:
             queryset = queryset.exclude(id=current_id)
-        while queryset.filter(slug=slug).exists():
+        used = set(queryset.values_list("slug", flat=True))
+        slug = base_slug
+        suffix = 1
+        while slug in used:
             suffix += 1
             slug = f"{base_slug}-{suffix}"
         return slug
@@ -282,7 +346,7 @@ class PromptCommandProcessor(
         data: dict,
         *,
         default_field: str,
-        allowed_fields: dict[str, str | Sequence[str]],
+        ordering: OrderingTable,
         default_direction: str = "asc",
     ) -> List[str]:
         default_field_name = default_field.lstrip("+-")
@@ -303,36 +367,20 @@ class PromptCommandProcessor(
             or direction_default
         )
         direction_value = str(raw_direction or direction_default).strip().lower()
-        if direction_value in {"ascendente", "ascending"}:
-            direction_value = "asc"
-        if direction_value in {"descendente", "descending"}:
-            direction_value = "desc"
-        if direction_value not in {"asc", "desc"}:
+        direction_value = _DIRECTION_ALIASES.get(direction_value)
+        if direction_value is None:
             raise PromptServiceError(
                 "La direccion de orden proporcionada no es valida. Use 'asc' o 'desc'."
             )
 
-        resolved = allowed_fields.get(order_key)
+        resolved = ordering.get(order_key)
         if resolved is None:
-            valid_keys = ", ".join(sorted(allowed_fields.keys()))
+            valid_keys = ", ".join(sorted(ordering.keys()))
             raise PromptServiceError(
                 f"El campo de orden '{order_key}' no es valido. Opciones permitidas: {valid_keys}."
             )
 
-        if isinstance(resolved, (list, tuple)):
-            fields = list(resolved)
-        else:
-            fields = [resolved]
-
-        ordered_fields: List[str] = []
-        for field in fields:
-            field_name = field.lstrip("+-")
-            if direction_value == "desc":
-                ordered_fields.append(f"-{field_name}")
-            else:
-                ordered_fields.append(field_name)
-
-        return ordered_fields
+        return list(resolved[1] if direction_value == "desc" else resolved[0])
 
     def _normalize_metric_list(
         self,
@@ -367,8 +415,13 @@ class PromptCommandProcessor(
         return f"{normalized} EUR"
 
     def _format_datetime(self, value) -> str:
+        # Same output as strftime("%Y-%m-%d %H:%M") without parsing a format
+        # string for every purchase line.
         try:
-            return value.strftime("%Y-%m-%d %H:%M")
+            return (
+                f"{value.year:04d}-{value.month:02d}-{value.day:02d} "
+                f"{value.hour:02d}:{value.minute:02d}"
+            )
         except Exception:  # pragma: no cover - defensive fallback
             return str(value)
 
@@ -409,27 +462,7 @@ class PromptCommandProcessor(
         return "Datos invalidos."
 
     def _build_help_message(self) -> str:
-        return (
-            "Comandos JSON disponibles:\n"
-            '- Listar categorias: {"action": "list_categories"}\n'
-            '- Crear categoria: {"action": "create_category", "data": {"name": "Snacks"}}\n'
-            '- Actualizar categoria: {"action": "update_category", "data": {"category_slug": "snacks", "name": "Bebidas"}}\n'
-            '- Eliminar categoria por id: {"action": "delete_category", "data": {"category_id": 3}}\n'
-            '- Asignar categoria: {"action": "assign_category", "data": {"product_id": 1, "category_id": 3}}\n'
-            '- Asignar categoria a todos: {"action": "assign_category_to_all_products", "data": {"category_id": 3}}\n'
-            '- Desasignar categoria: {"action": "unassign_category", "data": {"product_id": 1, "category_id": 3}}\n'
-            '- Listar productos: {"action": "list_products"}\n'
-            '- Crear producto: {"action": "create_product", "data": {"name": "Cafe", "price": "9.99", "stock": 10}}\n'
-            '- Actualizar producto: {"action": "update_product", "data": {"product_id": 1, "price": "12.50"}}\n'
-            '- Eliminar producto: {"action": "delete_product", "data": {"product_id": 1}}\n'
-            '- Metricas de productos: {"action": "product_metrics", "data": {"metrics": ["max_price", "min_price"]}}\n'
-            '- Listar compras: {"action": "list_purchases", "data": {"order_by": "total", "direction": "desc", "start_date": "2024-01-01", "end_date": "2024-01-31", "min_price": "10.00", "product_slug": "cafe"}}\n'
-            '- Crear compra: {"action": "create_purchase", "data": {"items": [{"product_id": 1, "quantity": 2}]}}\n'
-            '- Eliminar compra: {"action": "delete_purchase", "data": {"purchase_id": 5, "confirm": true}}\n'
-            '- Eliminar compras por producto: {"action": "delete_purchases_by_product", "data": {"product_slug": "cafe", "confirm": true}}\n'
-            '- Metricas de compras: {"action": "purchase_metrics", "data": {"metrics": ["max_price", "max_items"]}}\n'
-            "Escribe 'help' para volver a ver esta lista."
-        )
+        return _HELP_MESSAGE
     
     def _parse_datetime_boundary(
         self,
@@ -2,16 +2,43 @@
 
 from __future__ import annotations
 
+from collections import defaultdict
 from decimal import Decimal
-from typing import List
+from typing import Dict, List
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
 
-from core.cart.models import Cart
+from core.cart.models import Cart, CartItem
 from core.products.models import Category, Product
 
-from .common import GROQ_CHAT_URL, LOG, PromptServiceError, extract_error_detail
+from .common import (
+    GROQ_CHAT_URL,
+    GROQ_SESSION,
+    LOG,
+    PromptServiceError,
+    catalog_version,
+    extract_error_detail,
+    json_dumps,
+    json_loads,
+)
+
+_SYSTEM_PROMPT = (
+    "Eres un asistente experto en el catalogo de productos de una tienda. "
+    "Para cada consulta debes: (1) identificar exactamente la informacion solicitada, "
+    "(2) revisar el catalogo proporcionado, (3) realizar los calculos necesarios (maximos, "
+    "minimos, promedios, conteos, filtros, ordenaciones) y (4) responder de forma directa y "
+    "concreta en espanol neutro. No enumeres todo el catalogo salvo que el usuario lo pida "
+    "explicitamente; limita la respuesta a los datos relevantes. Si la pregunta no esta "
+    "relacionada con los productos disponibles, indica que no puedes responder."
+)
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+
+CATALOG_CONTEXT_CACHE_PREFIX = "prompt_catalog_context:v1"
+CATALOG_CONTEXT_CACHE_TIMEOUT = 60
+PURCHASES_CONTEXT_MAX_ROWS = 20
 
 
 class ProductPromptService:
@@ -19,7 +46,11 @@ class ProductPromptService:
 
     def __init__(self, api_key: str | None = None, model: str | None = None) -> None:
         self.api_key = (api_key or getattr(settings, "GROQ_API_KEY", "")).strip()
-        self.model = (model or getattr(settings, "GROQ_MODEL", "")).strip()
+        self.model = (model or getattr(settings, "GROQ_MODEL", "")).strip() or "llama3-70b-8192"
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
 
     def answer_question(self, question: str) -> str:
         question = (question or "").strip()
@@ -32,8 +63,7 @@ class ProductPromptService:
             )
 
         lower_question = question.lower()
-        products_block = self._build_products_context()
-        categories_block = self._build_categories_context()
+        products_block, categories_block = self._build_catalog_context()
         purchases_block, purchases_count = self._build_purchases_context()
 
         if purchases_count == 0 and any(
@@ -41,20 +71,9 @@ class ProductPromptService:
         ):
             return "No hay compras registradas actualmente."
         payload = {
-            "model": self.model or "llama3-70b-8192",
+            "model": self.model,
             "messages": [
-                {
-                    "role": "system",
-                    "content": (
-                        "Eres un asistente experto en el catalogo de productos de una tienda. "
-                        "Para cada consulta debes: (1) identificar exactamente la informacion solicitada, "
-                        "(2) revisar el catalogo proporcionado, (3) realizar los calculos necesarios (maximos, "
-                        "minimos, promedios, conteos, filtros, ordenaciones) y (4) responder de forma directa y "
-                        "concreta en espanol neutro. No enumeres todo el catalogo salvo que el usuario lo pida "
-                        "explicitamente; limita la respuesta a los datos relevantes. Si la pregunta no esta "
-                        "relacionada con los productos disponibles, indica que no puedes responder."
-                    ),
-                },
+                _SYSTEM_MESSAGE,
                 {
                     "role": "user",
                     "content": (
@@ -73,16 +92,11 @@ class ProductPromptService:
             "max_tokens": 256,
         }
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-
         try:
-            response = requests.post(
+            response = GROQ_SESSION.post(
                 GROQ_CHAT_URL,
-                json=payload,
-                headers=headers,
+                data=json_dumps(payload),
+                headers=self._headers,
                 timeout=30,
             )
         except requests.RequestException as exc:
@@ -97,7 +111,7 @@ class ProductPromptService:
             )
 
         try:
-            data = response.json()
+            data = json_loads(response.content)
         except ValueError as exc:
             raise PromptServiceError("Respuesta invalida del servicio LLM.") from exc
 
@@ -111,71 +125,83 @@ class ProductPromptService:
 
         return content
 
+    def _build_catalog_context(self) -> tuple[str, str]:
+        # Keyed on the catalog version, which every save, delete and category
+        # (un)assignment bumps, so a cache hit costs no queries.
+        cache_key = f"{CATALOG_CONTEXT_CACHE_PREFIX}:{catalog_version()}"
+        blocks = cache.get(cache_key)
+        if blocks is None:
+            blocks = (self._build_products_context(), self._build_categories_context())
+            cache.set(cache_key, blocks, CATALOG_CONTEXT_CACHE_TIMEOUT)
+        return blocks
+
     def _build_products_context(self) -> str:
-        products = (
-            Product.objects.all()
-            .order_by("price", "name")
-            .prefetch_related("categories")
+        products = list(
+            Product.objects.order_by("price", "name").values_list(
+                "id", "name", "price", "stock", "is_active"
+            )
         )
+        if not products:
+            return "No hay productos disponibles."
+
+        category_names: Dict[int, List[str]] = defaultdict(list)
+        for product_id, category_name in (
+            Product.categories.through.objects.order_by("category__name")
+            .values_list("product_id", "category__name")
+        ):
+            category_names[product_id].append(category_name)
+
         lines: List[str] = []
-        for product in products:
-            categories = ", ".join(
-                category.name for category in product.categories.all().order_by("name")
-            ) or "sin categorias"
+        for product_id, name, price, stock, is_active in products:
+            categories = ", ".join(category_names[product_id]) or "sin categorias"
+            active = "si" if is_active else "no"
             lines.append(
-                (
-                    "- Nombre: {name}; Precio: {price}; Stock: {stock}; Activo: {active}; "
-                    "Categorias: {categories}"
-                ).format(
-                    name=product.name,
-                    price=product.price,
-                    stock=product.stock,
-                    active="si" if product.is_active else "no",
-                    categories=categories,
-                )
+                f"- Nombre: {name}; Precio: {price}; Stock: {stock}; "
+                f"Activo: {active}; Categorias: {categories}"
             )
-        if not lines:
-            return "No hay productos disponibles."
         return "\n".join(lines)
 
     def _build_categories_context(self) -> str:
-        categories = (
-            Category.objects.all()
-            .order_by("name")
-            .prefetch_related("products")
+        categories = list(
+            Category.objects.order_by("name").values_list("id", "name", "slug", "is_active")
         )
         if not categories:
             return "No hay categorias registradas."
 
+        names_by_category: Dict[int, List[str]] = defaultdict(list)
+        for category_id, product_name in (
+            Product.categories.through.objects.order_by("product__name")
+            .values_list("category_id", "product__name")
+        ):
+            names_by_category[category_id].append(product_name)
+
         lines: List[str] = []
-        for category in categories:
-            product_names = ", ".join(
-                product.name for product in category.products.all().order_by("name")
-            ) or "sin productos"
-            status = "activa" if category.is_active else "inactiva"
+        for category_id, name, slug, is_active in categories:
+            product_names = ", ".join(names_by_category[category_id]) or "sin productos"
+            status = "activa" if is_active else "inactiva"
             lines.append(
-                (
-                    "- Nombre: {name}; Slug: {slug}; Estado: {status}; Productos: {products}".format(
-                        name=category.name,
-                        slug=category.slug,
-                        status=status,
-                        products=product_names,
-                    )
-                )
+                f"- Nombre: {name}; Slug: {slug}; Estado: {status}; Productos: {product_names}"
             )
         return "\n".join(lines)
 
     def _build_purchases_context(self) -> tuple[str, int]:
-        purchases = (
-            Cart.objects.all()
-            .prefetch_related("items__product")
-            .order_by("-created_at")
+        # Only the 20 newest purchases (and their items) are loaded; the total
+        # is counted separately only when there may be more of them.
+        purchases = list(
+            Cart.objects.prefetch_related(
+                Prefetch(
+                    "items",
+                    queryset=CartItem.objects.select_related("product").only(
+                        "id", "cart_id", "quantity", "unit_price", "product__id", "product__name"
+                    ),
+                )
+            ).order_by("-created_at")[:PURCHASES_CONTEXT_MAX_ROWS]
         )
         if not purchases:
             return "No hay compras registradas.", 0
 
         lines: List[str] = []
-        for purchase in purchases[:20]:
+        for purchase in purchases:
             item_descriptions = [
                 f"{item.product.name} x{item.quantity} ({self._format_currency(item.unit_price * item.quantity)})"
                 for item in purchase.items.all()
@@ -188,7 +214,10 @@ class ProductPromptService:
                 )
             )
 
-        return "\n".join(lines), purchases.count()
+        total = len(purchases)
+        if total == PURCHASES_CONTEXT_MAX_ROWS:
+            total = Cart.objects.count()
+        return "\n".join(lines), total
 
     def _format_currency(self, value) -> str:
         try:
@@ -2,15 +2,29 @@
 
 from __future__ import annotations
 
-from typing import List
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, List
 
 from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Max, Min, Value
 from django.db.models.deletion import ProtectedError
+from django.db.models.functions import Lower
 
 from core.products.models import Product
 
-from .common import PromptServiceError
+from .common import PromptServiceError, build_ordering_table
+
+_DEC_ZERO = Decimal("0")
+_LIST_PRODUCTS_ORDERING = build_ordering_table(
+    {
+        "name": ("name", "price"),
+        "nombre": ("name", "price"),
+        "price": ("price", "name"),
+        "precio": ("price", "name"),
+    }
+)
 
 
 class ProductCommandMixin:
@@ -22,17 +36,12 @@ class ProductCommandMixin:
         order_fields = self._extract_ordering(
             data,
             default_field="name",
-            allowed_fields={
-                "name": ("name", "price"),
-                "nombre": ("name", "price"),
-                "price": ("price", "name"),
-                "precio": ("price", "name"),
-            },
+            ordering=_LIST_PRODUCTS_ORDERING,
         )
-        products = (
-            Product.objects.all()
-            .order_by(*order_fields)
-            .prefetch_related("categories")
+        products = list(
+            Product.objects.order_by(*order_fields).values(
+                "id", "name", "slug", "price", "stock", "is_active"
+            )
         )
         if not products:
             return {
@@ -40,16 +49,21 @@ class ProductCommandMixin:
                 "answer": "No hay productos registrados.",
             }
 
+        category_names: Dict[int, List[str]] = defaultdict(list)
+        for product_id, category_name in (
+            Product.categories.through.objects.order_by("category__name")
+            .values_list("product_id", "category__name")
+        ):
+            category_names[product_id].append(category_name)
+
         lines: List[str] = []
         for product in products:
-            categories = ", ".join(
-                category.name for category in product.categories.all().order_by("name")
-            ) or "sin categorias"
-            status = "activo" if product.is_active else "inactivo"
+            categories = ", ".join(category_names[product["id"]]) or "sin categorias"
+            status = "activo" if product["is_active"] else "inactivo"
             lines.append(
                 (
-                    f"- id={product.id}, nombre={product.name}, slug={product.slug}, precio={product.price}, "
-                    f"stock={product.stock}, estado={status}, categorias={categories}"
+                    f"- id={product['id']}, nombre={product['name']}, slug={product['slug']}, precio={product['price']}, "
+                    f"stock={product['stock']}, estado={status}, categorias={categories}"
                 )
             )
 
@@ -82,7 +96,7 @@ class ProductCommandMixin:
 
         price = self._parse_decimal(data.get("price"), field="price")
         stock = self._parse_int(data.get("stock"), field="stock")
-        if price < 0:
+        if price < _DEC_ZERO:
             raise PromptServiceError("El precio del producto no puede ser negativo.")
         if stock < 0:
             raise PromptServiceError("El stock del producto no puede ser negativo.")
@@ -147,7 +161,7 @@ class ProductCommandMixin:
 
         if "price" in data:
             product.price = self._parse_decimal(data.get("price"), field="price")
-            if product.price < 0:
+            if product.price < _DEC_ZERO:
                 raise PromptServiceError("El precio del producto no puede ser negativo.")
             fields_updated.append("precio")
 
@@ -197,10 +211,7 @@ class ProductCommandMixin:
             if assign_categories:
                 product.categories.add(*assign_categories)
             if remove_categories:
-                for category in remove_categories:
-                    product.categories.remove(category)
-
-        product.refresh_from_db()
+                product.categories.remove(*remove_categories)
 
         parts = fields_updated if fields_updated else ["sin cambios en campos simples"]
         detail = "Producto actualizado."
@@ -209,9 +220,19 @@ class ProductCommandMixin:
             "Campos: " + ", ".join(parts),
         ]
         if categories is not None:
+            # The final set is known locally: replacement + additions - removals.
+            removed_ids = {category.id for category in remove_categories or []}
+            final_categories = {
+                category.id: category
+                for category in [*categories, *(assign_categories or [])]
+                if category.id not in removed_ids
+            }
             answer_lines.append(
                 "Categorias asignadas en total: "
-                + (", ".join(category.name for category in product.categories.all().order_by("name")) or "sin categorias")
+                + (
+                    ", ".join(sorted(category.name for category in final_categories.values()))
+                    or "sin categorias"
+                )
             )
         if assign_categories:
             answer_lines.append(
@@ -265,15 +286,28 @@ class ProductCommandMixin:
                     f"La metrica solicitada '{metric}' no es valida para productos."
                 )
 
-        if not Product.objects.exists():
+        bounds = Product.objects.aggregate(max_price=Max("price"), min_price=Min("price"))
+        if bounds["max_price"] is None:
             return {
                 "detail": "Metricas de producto consultadas.",
                 "answer": "No hay productos registrados para calcular metricas.",
             }
 
+        # Ties on price resolve to the first product by name.
+        selected: Dict[str, Product] = {}
+        candidates = (
+            Product.objects.filter(price__in={bounds[metric] for metric in metrics})
+            .only("id", "name", "price")
+            .order_by("name")
+        )
+        for product in candidates:
+            for metric in metrics:
+                if product.price == bounds[metric]:
+                    selected.setdefault(metric, product)
+
         lines: List[str] = []
         for metric in metrics:
-            product = self._select_product_by_metric(metric)
+            product = selected.get(metric)
             if product is None:
                 continue
             lines.append(
@@ -292,27 +326,33 @@ class ProductCommandMixin:
 
     def _resolve_product(self, data: dict, prefix: str = "product") -> Product:
         if f"{prefix}_id" in data:
-            try:
-                return Product.objects.get(id=data[f"{prefix}_id"])
-            except Product.DoesNotExist as exc:
+            product = Product.objects.filter(id=data[f"{prefix}_id"]).first()
+            if product is None:
                 raise PromptServiceError(
                     f"Producto con id={data[f'{prefix}_id']} no existe."
-                ) from exc
+                )
+            return product
 
         if f"{prefix}_slug" in data:
             slug = (data.get(f"{prefix}_slug") or "").strip()
             if not slug:
                 raise PromptServiceError("El slug del producto no puede estar vacio.")
-            try:
-                return Product.objects.get(slug=slug)
-            except Product.DoesNotExist as exc:
-                raise PromptServiceError(f"Producto con slug '{slug}' no existe.") from exc
+            product = Product.objects.filter(slug=slug).first()
+            if product is None:
+                raise PromptServiceError(f"Producto con slug '{slug}' no existe.")
+            return product
 
         if f"{prefix}_name" in data:
             name = (data.get(f"{prefix}_name") or "").strip()
             if not name:
                 raise PromptServiceError("El nombre del producto no puede estar vacio.")
-            matches = list(Product.objects.filter(name__iexact=name))
+            # Both sides go through LOWER() so the comparison folds case the
+            # same way the database does, accented names included.
+            matches = list(
+                Product.objects.annotate(name_lower=Lower("name")).filter(
+                    name_lower=Lower(Value(name))
+                )[:2]
+            )
             if not matches:
                 raise PromptServiceError(f"Producto '{name}' no existe.")
             if len(matches) > 1:
@@ -323,12 +363,5 @@ class ProductCommandMixin:
 
         raise PromptServiceError("No se proporciono informacion suficiente del producto.")
 
-    def _select_product_by_metric(self, metric: str) -> Product | None:
-        if metric == "max_price":
-            return Product.objects.order_by("-price", "name").first()
-        if metric == "min_price":
-            return Product.objects.order_by("price", "name").first()
-        return None
-
 
 __all__ = ["ProductCommandMixin"]
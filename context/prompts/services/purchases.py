@@ -3,15 +3,60 @@
 from __future__ import annotations
 
 from decimal import Decimal
-from typing import List, Sequence
+from functools import reduce
+from operator import itemgetter, or_
+from typing import Dict, List, Sequence
 
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Case, F, IntegerField, Max, Min, Prefetch, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Now
 
 from core.cart.models import Cart, CartItem
 from core.products.models import Product
 
-from .common import PromptServiceError
+from .common import PromptServiceError, build_ordering_table, bump_catalog_version, match_names
+
+_LIST_PURCHASES_ORDERING = build_ordering_table(
+    {
+        "precio": ("total_price", "id"),
+        "price": ("total_price", "id"),
+        "total": ("total_price", "id"),
+        "total_price": ("total_price", "id"),
+        "nombre": ("id", "created_at"),
+        "name": ("id", "created_at"),
+        "id": ("id", "created_at"),
+        "fecha": ("created_at", "id"),
+        "created_at": ("created_at", "id"),
+    }
+)
+
+# metric -> (aggregate, annotated field, pick function, tie-break key)
+_PURCHASE_METRIC_RULES = {
+    "max_price": (Max, "total_price", max, itemgetter("total_price", "created_at")),
+    "min_price": (Min, "total_price", min, itemgetter("total_price", "created_at")),
+    "max_items": (Max, "total_items", max, itemgetter("total_items", "total_price")),
+    "min_items": (Min, "total_items", min, itemgetter("total_items", "total_price")),
+}
+
+
+def _summary_items_prefetch() -> Prefetch:
+    """Prefetch purchase items with just what _format_purchase_summary prints."""
+
+    return Prefetch(
+        "items",
+        queryset=CartItem.objects.select_related("product").only(
+            "id", "cart_id", "quantity", "unit_price", "product__id", "product__name"
+        ),
+    )
+
+
+def _stock_items_prefetch() -> Prefetch:
+    """Prefetch purchase items with just what is needed to restore stock."""
+
+    return Prefetch(
+        "items",
+        queryset=CartItem.objects.only("id", "cart_id", "product_id", "quantity"),
+    )
 
 
 class PurchaseCommandMixin:
@@ -23,17 +68,7 @@ class PurchaseCommandMixin:
         order_fields = self._extract_ordering(
             data,
             default_field="-created_at",
-            allowed_fields={
-                "precio": ("total_price", "id"),
-                "price": ("total_price", "id"),
-                "total": ("total_price", "id"),
-                "total_price": ("total_price", "id"),
-                "nombre": ("id", "created_at"),
-                "name": ("id", "created_at"),
-                "id": ("id", "created_at"),
-                "fecha": ("created_at", "id"),
-                "created_at": ("created_at", "id"),
-            },
+            ordering=_LIST_PURCHASES_ORDERING,
             default_direction="desc",
         )
 
@@ -42,7 +77,7 @@ class PurchaseCommandMixin:
         purchases = (
             purchases_qs
             .annotate(total_items=Sum("items__quantity"))
-            .prefetch_related("items__product")
+            .prefetch_related(_summary_items_prefetch())
             .order_by(*order_fields)
         )
 
@@ -72,37 +107,58 @@ class PurchaseCommandMixin:
                 "Para registrar la compra debe especificar al menos un producto con su cantidad."
             )
 
+        # A product may appear in several entries; stock is checked per product.
+        products: Dict[int, Product] = {}
+        requested: Dict[int, int] = {}
         for product, quantity in items:
             if quantity <= 0:
                 raise PromptServiceError(
                     f"La cantidad indicada para el producto {product.name} debe ser mayor que cero."
                 )
-            if product.stock < quantity:
-                raise PromptServiceError(
-                    f"El producto {product.name} no dispone de stock suficiente para {quantity} unidad(es)."
-                )
+            products.setdefault(product.pk, product)
+            requested[product.pk] = requested.get(product.pk, 0) + quantity
 
         with transaction.atomic():
-            cart = Cart.objects.create(total_price=Decimal("0.00"))
-            total_price = Decimal("0.00")
-            for product, quantity in items:
-                line_total = product.price * quantity
-                CartItem.objects.create(
-                    cart=cart,
-                    product=product,
-                    quantity=quantity,
-                    unit_price=product.price,
-                )
-                total_price += line_total
-                product.stock -= quantity
-                product.save(update_fields=["stock"])
+            # Lock the rows in id order so concurrent purchases queue up instead
+            # of deadlocking, and read stock and price from the locked rows.
+            locked = {
+                product_id: (stock, price)
+                for product_id, stock, price in Product.objects.select_for_update()
+                .filter(pk__in=requested)
+                .order_by("id")
+                .values_list("id", "stock", "price")
+            }
+            for product_id, quantity in requested.items():
+                if product_id not in locked or locked[product_id][0] < quantity:
+                    raise PromptServiceError(
+                        f"El producto {products[product_id].name} no dispone de stock suficiente para {quantity} unidad(es)."
+                    )
 
-            cart.total_price = total_price
-            cart.save(update_fields=["total_price"])
+            total_price = sum(
+                (locked[product.pk][1] * quantity for product, quantity in items),
+                Decimal("0.00"),
+            )
+            cart = Cart.objects.create(total_price=total_price)
+            cart_items = CartItem.objects.bulk_create(
+                [
+                    CartItem(
+                        cart=cart,
+                        product=product,
+                        quantity=quantity,
+                        unit_price=locked[product.pk][1],
+                    )
+                    for product, quantity in items
+                ]
+            )
+            self._apply_stock_deltas(
+                {product_id: -quantity for product_id, quantity in requested.items()}
+            )
 
-        cart.refresh_from_db()
-        total_items = sum(item.quantity for item in cart.items.all())
-        summary = self._format_purchase_summary(cart, total_items_override=total_items)
+        summary = self._format_purchase_summary(
+            cart,
+            items=cart_items,
+            total_items_override=sum(requested.values()),
+        )
 
         return {
             "detail": "Compra registrada.",
@@ -121,7 +177,7 @@ class PurchaseCommandMixin:
             prompt=confirm_prompt,
         )
 
-        self._delete_purchase_instance(purchase)
+        self._delete_purchases([purchase])
 
         return {
             "detail": "Compra eliminada.",
@@ -134,7 +190,7 @@ class PurchaseCommandMixin:
         purchases = list(
             Cart.objects.filter(items__product=product)
             .distinct()
-            .prefetch_related("items__product")
+            .prefetch_related(_stock_items_prefetch())
         )
 
         if not purchases:
@@ -156,9 +212,7 @@ class PurchaseCommandMixin:
             prompt=confirm_prompt,
         )
 
-        with transaction.atomic():
-            for purchase in purchases:
-                self._delete_purchase_instance(purchase, use_transaction=False)
+        self._delete_purchases(purchases)
 
         return {
             "detail": "Compras eliminadas.",
@@ -183,25 +237,46 @@ class PurchaseCommandMixin:
                     f"La metrica solicitada '{metric}' no es valida para compras."
                 )
 
-        purchases_qs = Cart.objects.annotate(total_items=Sum("items__quantity"))
-        if not purchases_qs.exists():
+        # One aggregate finds the bounds, one query loads the carts on them.
+        purchases_qs = Cart.objects.annotate(
+            total_items=Coalesce(Sum("items__quantity"), 0)
+        )
+        requested = dict.fromkeys(metrics)
+        bounds = purchases_qs.aggregate(
+            **{
+                metric: _PURCHASE_METRIC_RULES[metric][0](_PURCHASE_METRIC_RULES[metric][1])
+                for metric in requested
+            }
+        )
+        if all(value is None for value in bounds.values()):
             return {
                 "detail": "Metricas de compra consultadas.",
                 "answer": "No hay compras registradas para calcular metricas.",
             }
 
+        candidates = list(
+            purchases_qs.filter(
+                reduce(
+                    or_,
+                    (
+                        Q(**{_PURCHASE_METRIC_RULES[metric][1]: bound})
+                        for metric, bound in bounds.items()
+                    ),
+                )
+            ).values("id", "total_price", "created_at", "total_items")
+        )
+
         lines: List[str] = []
         for metric in metrics:
-            purchase = self._select_purchase_by_metric(metric)
-            if purchase is None:
+            _, field, pick, tie_break = _PURCHASE_METRIC_RULES[metric]
+            matches = [row for row in candidates if row[field] == bounds[metric]]
+            if not matches:
                 continue
-            total_items = getattr(purchase, "total_items", None)
-            if total_items is None:
-                total_items = sum(item.quantity for item in purchase.items.all())
+            purchase = pick(matches, key=tie_break)
             lines.append(
                 (
-                    f"{allowed_labels[metric]}: Compra #{purchase.id} con total {self._format_currency(purchase.total_price)} "
-                    f"y {int(total_items)} articulo(s)."
+                    f"{allowed_labels[metric]}: Compra #{purchase['id']} con total {self._format_currency(purchase['total_price'])} "
+                    f"y {int(purchase['total_items'])} articulo(s)."
                 )
             )
 
@@ -281,56 +356,102 @@ class PurchaseCommandMixin:
 
         return queryset
 
-    def _delete_purchase_instance(self, purchase: Cart, *, use_transaction: bool = True) -> None:
-        def _perform_delete():
-            for item in purchase.items.all():
-                product = item.product
-                product.stock += item.quantity
-                product.save(update_fields=["stock"])
-            purchase.delete()
+    def _delete_purchases(self, purchases: Sequence[Cart]) -> None:
+        """Restore the stock of every item and delete the purchases in bulk."""
 
-        if use_transaction:
-            with transaction.atomic():
-                _perform_delete()
-        else:
-            _perform_delete()
+        restored: Dict[int, int] = {}
+        for purchase in purchases:
+            for item in purchase.items.all():
+                restored[item.product_id] = restored.get(item.product_id, 0) + item.quantity
+        with transaction.atomic():
+            self._apply_stock_deltas(restored)
+            Cart.objects.filter(id__in=[purchase.id for purchase in purchases]).delete()
+
+    def _apply_stock_deltas(self, deltas: Dict[int, int]) -> None:
+        """Add each delta to its product's stock with a single UPDATE."""
+
+        if not deltas:
+            return
+        # QuerySet.update() skips auto_now and the model signals, so set
+        # updated_at and bump the catalog context version explicitly.
+        Product.objects.filter(pk__in=deltas).update(
+            stock=F("stock")
+            + Case(
+                *[When(pk=product_id, then=Value(delta)) for product_id, delta in deltas.items()],
+                output_field=IntegerField(),
+            ),
+            updated_at=Now(),
+        )
+        bump_catalog_version()
 
     def _parse_purchase_items(self, value) -> List[tuple[Product, int]]:
-        if isinstance(value, str) or not isinstance(value, Sequence):
+        if not isinstance(value, (list, tuple)):
             raise PromptServiceError(
                 "Los articulos de la compra deben proporcionarse como una lista de elementos."
             )
 
-        parsed: List[tuple[Product, int]] = []
+        # Each entry is identified by id, slug or name, in the same precedence
+        # as _resolve_product; all entries are then resolved with one query
+        # per identifier kind.
+        lookups: List[tuple[str, str, int]] = []
         for entry in value:
             if isinstance(entry, dict):
                 quantity = self._parse_int(entry.get("quantity"), field="quantity")
-                product_data = {}
-                if entry.get("product_id") is not None:
-                    product_data["product_id"] = entry.get("product_id")
-                if entry.get("id") is not None and "product_id" not in product_data:
-                    product_data["product_id"] = entry.get("id")
-                if entry.get("product_slug") is not None:
-                    product_data["product_slug"] = entry.get("product_slug")
-                if entry.get("slug") is not None and "product_slug" not in product_data:
-                    product_data["product_slug"] = entry.get("slug")
-                if entry.get("product_name") is not None:
-                    product_data["product_name"] = entry.get("product_name")
-                if entry.get("name") is not None and "product_name" not in product_data:
-                    product_data["product_name"] = entry.get("name")
-                if not product_data:
+                for kind, keys in (
+                    ("id", ("product_id", "id")),
+                    ("slug", ("product_slug", "slug")),
+                    ("name", ("product_name", "name")),
+                ):
+                    identifier = next(
+                        (entry[key] for key in keys if entry.get(key) is not None), None
+                    )
+                    if identifier is not None:
+                        break
+                else:
                     raise PromptServiceError(
                         "Uno de los articulos no incluye un identificador de producto valido."
                     )
-                product = self._resolve_product(product_data)
             elif isinstance(entry, (list, tuple)) and len(entry) >= 2:
-                product = self._resolve_product({"product_id": entry[0]})
+                kind, identifier = "id", entry[0]
                 quantity = self._parse_int(entry[1], field="quantity")
             else:
                 raise PromptServiceError(
                     "No se pudo interpretar uno de los articulos de la compra."
                 )
+            lookups.append((kind, str(identifier).strip(), quantity))
+
+        ids = {int(key) for kind, key, _ in lookups if kind == "id" and key.isdigit()}
+        slugs = {key for kind, key, _ in lookups if kind == "slug" and key}
+        names = {key for kind, key, _ in lookups if kind == "name" and key}
+        by_id = Product.objects.in_bulk(ids) if ids else {}
+        by_slug = Product.objects.in_bulk(slugs, field_name="slug") if slugs else {}
+        by_name: Dict[str, List[Product]] = {}
+        if names:
+            _, by_name = match_names(Product.objects.all(), names)
 
+        parsed: List[tuple[Product, int]] = []
+        for kind, key, quantity in lookups:
+            if kind == "id":
+                product = by_id.get(int(key)) if key.isdigit() else None
+                if product is None:
+                    raise PromptServiceError(f"Producto con id={key} no existe.")
+            elif kind == "slug":
+                if not key:
+                    raise PromptServiceError("El slug del producto no puede estar vacio.")
+                product = by_slug.get(key)
+                if product is None:
+                    raise PromptServiceError(f"Producto con slug '{key}' no existe.")
+            else:
+                if not key:
+                    raise PromptServiceError("El nombre del producto no puede estar vacio.")
+                matches = by_name.get(key, [])
+                if not matches:
+                    raise PromptServiceError(f"Producto '{key}' no existe.")
+                if len(matches) > 1:
+                    raise PromptServiceError(
+                        f"Existen varios productos con el nombre '{key}'. Usa el id o slug."
+                    )
+                product = matches[0]
             parsed.append((product, quantity))
 
         return parsed
@@ -346,33 +467,29 @@ class PurchaseCommandMixin:
         except (TypeError, ValueError) as exc:
             raise PromptServiceError("El identificador de la compra debe ser un numero entero.") from exc
 
-        try:
-            return Cart.objects.prefetch_related("items__product").get(id=purchase_id)
-        except Cart.DoesNotExist as exc:
-            raise PromptServiceError(f"No existe una compra con id={purchase_id}.") from exc
-
-    def _select_purchase_by_metric(self, metric: str) -> Cart | None:
-        qs = Cart.objects.annotate(total_items=Sum("items__quantity")).prefetch_related("items__product")
-        if metric == "max_price":
-            return qs.order_by("-total_price", "-created_at").first()
-        if metric == "min_price":
-            return qs.order_by("total_price", "created_at").first()
-        if metric == "max_items":
-            return qs.order_by("-total_items", "-total_price").first()
-        if metric == "min_items":
-            return qs.order_by("total_items", "total_price").first()
-        return None
-
-    def _format_purchase_summary(self, purchase: Cart, *, total_items_override: int | None = None) -> str:
+        purchase = Cart.objects.prefetch_related(_stock_items_prefetch()).filter(id=purchase_id).first()
+        if purchase is None:
+            raise PromptServiceError(f"No existe una compra con id={purchase_id}.")
+        return purchase
+
+    def _format_purchase_summary(
+        self,
+        purchase: Cart,
+        *,
+        items: Sequence[CartItem] | None = None,
+        total_items_override: int | None = None,
+    ) -> str:
+        if items is None:
+            items = list(purchase.items.all())
         total_items = total_items_override
         if total_items is None:
             total_items = getattr(purchase, "total_items", None)
         if total_items is None:
-            total_items = sum(item.quantity for item in purchase.items.all())
+            total_items = sum(item.quantity for item in items)
 
         item_descriptions = [
             f"{item.product.name} x{item.quantity} ({self._format_currency(item.line_total)})"
-            for item in purchase.items.all()
+            for item in items
         ]
         items_text = ", ".join(item_descriptions) if item_descriptions else "sin productos registrados"
 
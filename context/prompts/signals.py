@@ -0,0 +1,28 @@
+"""Bump the prompt context cache versions whenever the catalog changes."""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from core.cart.models import Cart
+from core.products.models import Category, Product
+
+from .services.common import bump_catalog_version
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+def catalog_changed(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def product_categories_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        bump_catalog_version()
+
+
+@receiver([post_save, post_delete], sender=Cart)
+def purchases_changed(sender, **kwargs):
+    # Carts are saved before their items inside the same transaction, and the
+    # bump only runs on commit, so the new version always sees the items.
+    bump_catalog_version(purchases=True)
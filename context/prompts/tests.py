@@ -0,0 +1,55 @@
+import json
+
+from django.test import TestCase
+
+from core.cart.models import Cart
+from core.products.models import Category, Product
+
+from .services import PromptCommandProcessor
+
+
+class AccentedNameLookupTests(TestCase):
+    """Name lookups must match accented names the same way the database folds them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Óleo", slug="oleo")
+        cls.product = Product.objects.create(name="CAFÉ", slug="cafe", price="2.50", stock=5)
+
+    def run_command(self, action: str, data: dict) -> dict:
+        return PromptCommandProcessor().process_if_command(
+            json.dumps({"action": action, "data": data})
+        )
+
+    def test_assign_category_by_accented_name(self):
+        self.run_command(
+            "assign_category", {"product_name": "CaFÉ", "category_name": "ÓLEO"}
+        )
+        self.assertTrue(self.product.categories.filter(pk=self.category.pk).exists())
+
+    def test_assign_category_by_accented_slug_token(self):
+        self.run_command(
+            "assign_category", {"product_name": "CAFÉ", "category_slug": "Óleo"}
+        )
+        self.assertTrue(self.product.categories.filter(pk=self.category.pk).exists())
+
+    def test_create_product_with_accented_category_names(self):
+        self.run_command(
+            "create_product",
+            {
+                "name": "Pincel",
+                "price": "1.00",
+                "stock": 3,
+                "categories": ["Óleo", {"category_name": "ÓLEO"}],
+            },
+        )
+        product = Product.objects.get(slug="pincel")
+        self.assertEqual(list(product.categories.all()), [self.category])
+
+    def test_create_purchase_with_accented_product_name(self):
+        self.run_command(
+            "create_purchase", {"items": [{"product_name": "CaFÉ", "quantity": 2}]}
+        )
+        self.assertEqual(Cart.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-16 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['-created_at'], name='cart_cart_created_8a2171_idx'),
+        ),
+    ]
@@ -14,6 +14,10 @@ class Cart(models.Model):
 
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            models.Index(fields=["-created_at"]),
+            models.Index(fields=["total_price", "created_at"]),
+        ]
 
     def __str__(self) -> str:
         return f"Carrito #{self.pk}"
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-16 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core_products', '0002_category_product_categories'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_active', 'name'], name='core_produc_is_acti_8ab207_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-16 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core_products', '0003_product_core_produc_is_acti_8ab207_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'name'], name='core_produc_price_1d548b_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-16 03:30
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core_products', '0004_product_core_produc_price_1d548b_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='core_produc_cat_lower_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='core_produc_lower_name_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 
 
 class Category(models.Model):
@@ -13,6 +14,9 @@ class Category(models.Model):
 
     class Meta:
         ordering = ("name",)
+        indexes = [
+            models.Index(Lower("name"), name="core_produc_cat_lower_name_idx"),
+        ]
 
     def __str__(self) -> str:
         return self.name
@@ -33,6 +37,11 @@ class Product(models.Model):
 
     class Meta:
         ordering = ("name",)
+        indexes = [
+            models.Index(fields=["is_active", "name"]),
+            models.Index(fields=["price", "name"]),
+            models.Index(Lower("name"), name="core_produc_lower_name_idx"),
+        ]
 
     def __str__(self) -> str:
         return self.name